@@ -3,24 +3,244 @@ This module creates the interface to the GBIF API. By providing queries to the a
 this module to obtain lists of urls of media data to be downloaded using the [io](gbif_dl.io) module.
 """
 
-import pygbif
+import functools
+import inspect
 import itertools as it
 import random
 import pescador
-import hashlib
 import logging
-import numpy as np
+import os
+import tempfile
+import requests
+import requests_cache
+import pygbif
+from pygbif.gbifutils import make_ua, requests_argset
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from ..io import MediaData
+from ..utils import hash_url
+
+from typing import Dict, Optional, Union, List, Set
 
-from typing import Dict, Optional, Union, List
+try:
+    # optional, decodes the large search pages several times faster than `json`
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
 log = logging.getLogger(__name__)
 
+GBIF_SEARCH_URL = "https://api.gbif.org/v1/occurrence/search"
+# the search api silently caps larger page limits to this value
+GBIF_MAX_PAGE_LIMIT = 300
+# concurrent count requests, kept low to stay within the GBIF rate limits
+MAX_COUNT_WORKERS = 8
+CACHE_NAME = os.path.join(tempfile.gettempdir(), "gbif_dl_requests_cache")
+
+
+def _create_session(cache_requests: bool = False) -> requests.Session:
+    """Creates a http session that reuses connections and retries rate limited requests"""
+    if cache_requests:
+        # sqlite writes every response as it arrives, so the cache survives crashes
+        session = requests_cache.CachedSession(CACHE_NAME, backend="sqlite", expire_after=86400)
+    else:
+        session = requests.Session()
+    # identify as pygbif based client, like the requests pygbif sends itself
+    session.headers.update(make_ua())
+    retries = Retry(total=5, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_SESSION = _create_session()
+
+
+def _reset_session(cache_requests: bool = False):
+    """Replaces the shared session when the requests cache is enabled or disabled"""
+    global _SESSION
+    # generators of earlier calls keep using the session, so it is only replaced on change
+    if isinstance(_SESSION, requests_cache.CachedSession) == cache_requests:
+        return
+    _SESSION.close()
+    _SESSION = _create_session(cache_requests)
+
+
+def _to_param(value):
+    """Converts python values into GBIF query parameters"""
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (list, tuple)):
+        return [_to_param(v) for v in value]
+    return value
+
+
+def _search(*args, **kwargs) -> Dict:
+    """Queries the GBIF occurrence search api using the shared session
+
+    Arguments are handled like `pygbif.occurrences.search`: positional arguments
+    follow its parameter order, `requests` arguments such as `timeout` are passed
+    to the request and underscores in query keys are replaced by dots.
+
+    Returns:
+        Dict: decoded search response
+    """
+    if args:
+        names = list(inspect.signature(pygbif.occurrences.search).parameters)
+        for name, value in zip(names, args):
+            if name in kwargs:
+                raise TypeError("got multiple values for argument '{}'".format(name))
+            kwargs[name] = value
+
+    request_kwargs = {"timeout": 60}
+    params = {}
+    for key, value in kwargs.items():
+        if key in requests_argset:
+            request_kwargs[key] = value
+        elif value is not None:
+            params[key.replace("_", ".")] = _to_param(value)
+
+    r = _SESSION.get(GBIF_SEARCH_URL, params=params, **request_kwargs)
+    r.raise_for_status()
+    if orjson is not None:
+        return orjson.loads(r.content)
+    return r.json()
+
+
+def _to_mediatypes(mediatype: Optional[Union[str, List[str]]]) -> Optional[Set[str]]:
+    """Converts the queried mediatype(s) into a set of lowercase names"""
+    if mediatype is None:
+        return None
+    if isinstance(mediatype, str):
+        mediatype = [mediatype]
+    return {m.lower() for m in mediatype}
+
+
+def _is_mediatype(media: Dict, mediatypes: Optional[Set[str]]) -> bool:
+    """Checks a media entry against the queried mediatypes, entries without type are kept"""
+    if mediatypes is None or "type" not in media:
+        return True
+    return str(media["type"]).lower() in mediatypes
+
+
+def _choose_media(medias: List[Dict], mediatypes: Optional[Set[str]]) -> Optional[Dict]:
+    """Picks one random media of the given type in a single pass (reservoir sampling)
+
+    Occurrences matching the mediatype filter can still carry media of other types,
+    e.g. a sound recording next to images, which should never be selected.
+    """
+    chosen = None
+    nb_candidates = 0
+    for media in medias:
+        if _is_mediatype(media, mediatypes):
+            nb_candidates += 1
+            if random.randrange(nb_candidates) == 0:
+                chosen = media
+    return chosen
+
+
+def gbif_query_page_generator(
+    page_limit: int = 300,
+    mediatype: Union[str, List[str]] = "StillImage",
+    license_info: bool = True,
+    one_media_per_occurrence: bool = True,
+    label: Optional[str] = None,
+    subset: Optional[str] = None,
+    *args,
+    **kwargs,
+) -> List[MediaData]:
+    """Performs media queries GBIF yielding the media of each result page as a list
+
+    Consumers that process records in bulk, e.g. to build a `pandas.DataFrame`
+    or to write an index file, avoid the per-item overhead of the item generators.
+
+    Args:
+        page_limit (int, optional): GBIF api uses paging which can be modified.
+            Values above the api maximum of 300 are capped. Defaults to 300.
+        mediatype (Union[str, List[str]], optional): Sets GBIF mediatype, media of other types
+            are skipped. Defaults to 'StillImage'.
+        license_info (bool, optional): Retrieve images license information. Default to True.
+        one_media_per_occurrence (bool, optional): Only pick one image per occurrence. Default to True.
+        label (str, optional): Output label name. Defaults to `None`.
+        subset (str, optional): Subset name. Defaults to `None`.
+
+    Yields:
+        List[MediaData]
+    """
+    # larger limits would make the offsets skip the records beyond the cap
+    page_limit = min(page_limit, GBIF_MAX_PAGE_LIMIT)
+
+    mediatypes = _to_mediatypes(mediatype)
+
+    # the query is bound once, each page only adds its offset
+    fetch_page = functools.partial(_search, *args, mediatype=mediatype, limit=page_limit, **kwargs)
+
+    # a single worker keeps the next page in flight while the current one is consumed
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        next_page = executor.submit(fetch_page, offset=0)
+        while True:
+            resp = next_page.result()
+            if not resp["endOfRecords"]:
+                next_page = executor.submit(fetch_page, offset=resp["offset"] + page_limit)
+
+            page = []
+            for metadata in resp.get("results", []):
+                # check if media key is present
+                medias = metadata.get("media", None)
+                # store the valid label
+                if label:
+                    # skip occurrences without label
+                    value = metadata.get(label)
+                    if value is None or value == "":
+                        continue
+                    output_label = str(value)
+                else:
+                    output_label = metadata
+                if medias:
+                    # multiple media can be attached
+                    if one_media_per_occurrence:
+                        # select one random url if one_media_per_occurrence
+                        media = _choose_media(medias, mediatypes)
+                        medias = [media] if media is not None else []
+                    else:
+                        medias = (m for m in medias if _is_mediatype(m, mediatypes))
+                    for media in medias:
+                        # check if the identifier (url) is present
+                        url = media.get("identifier", None)
+                        if url:
+                            # hash the url, which later becomes the datatype
+                            hashed_url = hash_url(url)
+
+                            media_data = {
+                                "url": url,
+                                "basename": hashed_url,
+                                "label": output_label,
+                                "subset": subset,
+                            }
+                            if license_info:
+                                media_data["publisher"] = media.get("publisher", None)
+                                media_data["license"] = media.get("license", None)
+                                media_data["rightsHolder"] = media.get(
+                                    "rightsHolder", media.get("creator", None)
+                                )
+                            page.append(media_data)
+
+            yield page
+
+            if resp["endOfRecords"]:
+                break
+    finally:
+        # do not block on an in-flight prefetch when the consumer stops early
+        executor.shutdown(wait=False)
+
 
 def gbif_query_generator(
     page_limit: int = 300,
-    mediatype: str = "StillImage",
+    mediatype: Union[str, List[str]] = "StillImage",
     license_info: bool = True,
     one_media_per_occurrence: bool = True,
     label: Optional[str] = None,
@@ -31,8 +251,10 @@ def gbif_query_generator(
     """Performs media queries GBIF yielding url and label
 
     Args:
-        page_limit (int, optional): GBIF api uses paging which can be modified. Defaults to 300.
-        mediatype (str, optional): Sets GBIF mediatype. Defaults to 'StillImage'.
+        page_limit (int, optional): GBIF api uses paging which can be modified.
+            Values above the api maximum of 300 are capped. Defaults to 300.
+        mediatype (Union[str, List[str]], optional): Sets GBIF mediatype, media of other types
+            are skipped. Defaults to 'StillImage'.
         license_info (bool, optional): Retrieve images license information. Default to True.
         one_media_per_occurrence (bool, optional): Only pick one image per occurrence. Default to True.
         label (str, optional): Output label name. Defaults to `None`.
@@ -41,59 +263,47 @@ def gbif_query_generator(
     Yields:
         MediaData
     """
-    offset = 0
+    for page in gbif_query_page_generator(
+        page_limit,
+        mediatype,
+        license_info,
+        one_media_per_occurrence,
+        label,
+        subset,
+        *args,
+        **kwargs,
+    ):
+        for media_data in page:
+            yield media_data
+
+
+def gbif_random_query_generator(nb_samples: Optional[int] = None, **kwargs) -> MediaData:
+    """Yields the media of a query in random order
 
-    while True:
-        resp = pygbif.occurrences.search(
-            mediatype=mediatype, offset=offset, limit=page_limit, *args, **kwargs
-        )
+    Args:
+        nb_samples (int, optional): Number of samples to be drawn. The query is still
+            read completely, but only a uniform random sample of this size is kept
+            in memory (reservoir sampling). Defaults to `None` which keeps all samples.
 
-        # Iterate over request pages. Can possibly also done async
-        for metadata in resp.get("results", []):
-            # check if media key is present
-            medias = metadata.get("media", None)
-            # store the valid label
-            if label:
-                output_label = str(metadata.get(label, None))
-                if output_label is None or not output_label:
-                    continue
+    Yields:
+        MediaData
+    """
+    rng = random.Random(4)
+    if nb_samples is None:
+        media_datas = []
+        for page in gbif_query_page_generator(**kwargs):
+            media_datas.extend(page)
+    else:
+        media_datas = []
+        for i, media_data in enumerate(gbif_query_generator(**kwargs)):
+            if i < nb_samples:
+                media_datas.append(media_data)
             else:
-                output_label = metadata
-            if medias:
-                # multiple media can be attached
-                if one_media_per_occurrence:
-                    # select one random url if one_media_per_occurrence
-                    medias = [random.choice(medias)]
-                for media in medias:
-                    # check if the identifier (url) is present
-                    url = media.get("identifier", None)
-                    if url:
-                        # hash the url, which later becomes the datatype
-                        hashed_url = hashlib.sha1(url.encode("utf-8")).hexdigest()
-
-                        media_data = {
-                            "url": url,
-                            "basename": hashed_url,
-                            "label": output_label,
-                            "subset": subset,
-                        }
-                        if license_info:
-                            media_data["publisher"] = media.get("publisher", None)
-                            media_data["license"] = media.get("license", None)
-                            media_data["rightsHolder"] = media.get(
-                                "rightsHolder", media.get("creator", None)
-                            )
-                        yield media_data
-
-        if resp["endOfRecords"]:
-            break
-        else:
-            offset = resp["offset"] + page_limit
-
+                j = rng.randrange(i + 1)
+                if j < nb_samples:
+                    media_datas[j] = media_data
 
-def gbif_random_query_generator(**kwargs):
-    media_datas = list(gbif_query_generator(**kwargs))
-    random.Random(4).shuffle(media_datas)
+    rng.shuffle(media_datas)
     for media_data in media_datas:
         yield media_data
 
@@ -108,7 +318,7 @@ def gbif_count(mediatype: str = "StillImage", *args, **kwargs) -> str:
         str: [description]
     """
 
-    return pygbif.occurrences.search(limit=0, mediatype=mediatype, *args, **kwargs)["count"]
+    return _search(*args, limit=0, mediatype=mediatype, **kwargs)["count"]
 
 
 def _dproduct(dicts):
@@ -116,6 +326,29 @@ def _dproduct(dicts):
     return (dict(zip(dicts, x)) for x in it.product(*dicts.values()))
 
 
+def _stream_subset(b: Dict, subset_streams: Optional[Dict]) -> Optional[str]:
+    """Returns the subset a stream is mapped into, value lists have to be given as sets"""
+    subset = None
+    if subset_streams is None:
+        return subset
+
+    for key, value in b.items():
+        for x, y in subset_streams.items():
+            result = y.get(key)
+            if result is not None:
+                if isinstance(result, set):
+                    if value in result:
+                        subset = x
+                else:
+                    if value == result:
+                        subset = x
+
+                # assign remainder class
+                if result == "*" and subset is None:
+                    subset = x
+    return subset
+
+
 def generate_urls(
     queries: Dict,
     label: Optional[str] = None,
@@ -140,6 +373,7 @@ def generate_urls(
             When set to -1 and `split_streams_by` is not `None`,
             a minimum number of samples will be calculated
             from using the number of available samples per stream.
+            Without `split_streams_by`, -1 retrieves all samples.
             Defaults to `None` which retrieves all samples from all streams until
             all streams are exchausted.
         nb_samples_per_stream (int): Limit the maximum number of items to be retrieved per stream.
@@ -157,7 +391,8 @@ def generate_urls(
             sampling. To be combined with nb_samples not `None`.
             Defaults to `False`.
         cache_requests (bool, optional): Enable GBIF API cache.
-            Can significantly improve API requests. Defaults to False.
+            Can significantly improve API requests. Responses are kept for 24 hours
+            in a sqlite database in the temporary directory. Defaults to False.
         mediatype (str): supported GBIF media type. Can be `StillImage`, `MovingImage`, `Sound`.
             Defaults to `StillImage`.
         license_info (bool): retrieve images license information. Default to True.
@@ -168,8 +403,8 @@ def generate_urls(
         Iterable: generate-like object, that yields dictionaries
     """
     streams = []
-    # set pygbif api caching
-    pygbif.caching(cache_requests)
+    # set api caching
+    _reset_session(cache_requests)
 
     # copy queries since we delete keys from the dict
     q = queries.copy()
@@ -188,38 +423,36 @@ def generate_urls(
         for key in split_streams_by:
             balance_queries[key] = q.pop(key)
 
+        # the product is reused for the streams and the counts
+        combos = list(_dproduct(balance_queries))
+
+        # subset value lists are turned into sets once instead of scanned per stream
+        if subset_streams is not None:
+            subset_streams = {
+                x: {key: set(v) if isinstance(v, list) else v for key, v in y.items()}
+                for x, y in subset_streams.items()
+            }
+
+        # arguments shared by all streams are only merged once
+        stream_kwargs = dict(
+            label=label,
+            mediatype=mediatype,
+            license_info=license_info,
+            one_media_per_occurrence=one_media_per_occurrence,
+            **q,
+        )
+
         # for each b in balance_queries, create a separate stream
         # later we control the sampling processs of these streams to balance them
-        for b in _dproduct(balance_queries):
-            subset = None
+        for b in combos:
             # for each stream we wrap into pescador Streamers for additional features
-            for key, value in b.items():
-                if subset_streams is not None:
-                    for x, y in subset_streams.items():
-                        result = y.get(key)
-                        if result is not None:
-                            if isinstance(result, list):
-                                for item in result:
-                                    if value == item:
-                                        subset = x
-                            else:
-                                if value == result:
-                                    subset = x
-
-                            # assign remainder class
-                            if result == "*" and subset is None:
-                                subset = x
-
             streams.append(
                 pescador.Streamer(
                     pescador.Streamer(
                         gbif_random_query_generator,
-                        label=label,
-                        mediatype=mediatype,
-                        subset=subset,
-                        license_info=license_info,
-                        one_media_per_occurrence=one_media_per_occurrence,
-                        **q,
+                        nb_samples=nb_samples_per_stream,
+                        subset=_stream_subset(b, subset_streams),
+                        **stream_kwargs,
                         **b,
                     ),
                     # this makes sure that we only obtain a maximum number
@@ -228,27 +461,29 @@ def generate_urls(
                 )
             )
 
+        # count the available occurances for each stream only once
+        # and reuse them for the balancing and the weights
+        if verbose or nb_samples == -1 or weighted_streams:
+            # count requests are independent, so run them concurrently
+            with ThreadPoolExecutor(max_workers=MAX_COUNT_WORKERS) as executor:
+                counts = list(
+                    executor.map(lambda b: gbif_count(mediatype=mediatype, **q, **b), combos)
+                )
+
         if verbose:
-            nb_queries = [
-                gbif_count(mediatype=mediatype, **q, **b) for b in _dproduct(balance_queries)
-            ]
+            print(counts)
 
-        # count the available occurances for each stream and select the min.
+        # select the min. of the counts.
         # We only yield the minimum of streams to balance
         if nb_samples == -1:
             # calculate the miniumum number of samples available per stream
-            nb_samples = min(
-                [gbif_count(mediatype=mediatype, **q, **b) for b in _dproduct(balance_queries)]
-            ) * len(streams)
+            nb_samples = min(counts) * len(streams)
 
         if weighted_streams:
-            weights = np.array(
-                [
-                    float(gbif_count(mediatype=mediatype, **q, **b))
-                    for b in _dproduct(balance_queries)
-                ]
-            )
-            weights /= np.max(weights)
+            # sampling probabilities proportional to the available samples,
+            # plain floats are enough for the handful of streams we weigh
+            total_count = sum(counts) or 1
+            weights = [count / total_count for count in counts]
         else:
             weights = None
 
@@ -263,16 +498,23 @@ def generate_urls(
 
     # else there will be only one stream, hence no balancing or sampling
     else:
-        if nb_samples and nb_samples_per_stream:
-            nb_samples = min(nb_samples, nb_samples_per_stream)
+        # without streams to balance, -1 simply retrieves all samples
+        if nb_samples == -1:
+            nb_samples = None
+        limits = [n for n in (nb_samples, nb_samples_per_stream) if n is not None]
+        nb_samples = min(limits) if limits else None
 
         if verbose:
             print(nb_samples)
-        return pescador.Streamer(
-            gbif_random_query_generator,
-            label=label,
-            mediatype=mediatype,
-            license_info=license_info,
-            one_media_per_occurrence=one_media_per_occurrence,
-            **q,
-        ).iterate(max_iter=nb_samples)
+        # a single stream needs no pescador bookkeeping, the generator is sliced directly
+        return it.islice(
+            gbif_random_query_generator(
+                nb_samples=nb_samples,
+                label=label,
+                mediatype=mediatype,
+                license_info=license_info,
+                one_media_per_occurrence=one_media_per_occurrence,
+                **q,
+            ),
+            nb_samples,
+        )
@@ -8,15 +8,17 @@ import pygbif
 from pathlib import Path
 import random
 import requests
-import hashlib
 import re
 import tempfile
-from typing import Optional
+import time
+from typing import Dict, Optional
 import os
 
 from ..io import MediaData
+from ..utils import hash_url
 
 from dwca.read import DwCAReader
+from pygbif.occurrences.download import key_lkup
 from typing import Optional
 
 mmqualname = "http://purl.org/dc/terms/"
@@ -64,12 +66,14 @@ def dwca_generator(
                 url = selected_img.get(mmqualname + "identifier", None)
                 if url:
                     # hash the url, which later becomes the datatype
-                    hashed_url = hashlib.sha1(url.encode("utf-8")).hexdigest()
+                    hashed_url = hash_url(url)
 
                     if label is not None:
-                        output_label = str(row.data.get(gbifqualname + label))
-                        if output_label is None or not output_label:
+                        # skip occurrences without label
+                        value = row.data.get(gbifqualname + label)
+                        if value is None or value == "":
                             continue
+                        output_label = str(value)
                     else:
                         output_label = row.data
 
@@ -133,6 +137,105 @@ def is_doi(identifier: str) -> bool:
     return False
 
 
+# search api style ranges, e.g. `year="2000,2010"` or `eventDate="*,2010-12-31"`
+_RANGE_PATTERN = re.compile(r"^\s*(\*|[\d.:T-]+)\s*,\s*(\*|[\d.:T-]+)\s*$")
+
+# download statuses after which the archive will never become available
+_FAILED_STATUSES = ("CANCELLED", "FAILED", "KILLED", "SUSPENDED", "FILE_ERASED")
+
+
+def _to_value(value):
+    """Converts python values into GBIF predicate values, booleans become lowercase strings"""
+    if isinstance(value, bool):
+        return str(value).lower()
+    return value
+
+
+def _to_predicate(key: str, value) -> Dict:
+    """Converts a query item into a GBIF download predicate
+
+    Raises:
+        ValueError: If the key or value cannot be expressed as a download predicate.
+    """
+    gbif_key = key_lkup.get(key)
+    if gbif_key is None:
+        raise ValueError("Query key {} is not supported by GBIF downloads".format(key))
+
+    if isinstance(value, (list, tuple)):
+        values = [_to_value(v) for v in value]
+        if any(isinstance(v, str) and _RANGE_PATTERN.match(v) for v in values):
+            raise ValueError("Ranges of {} cannot be combined in a list".format(key))
+        return {"type": "in", "key": gbif_key, "values": values}
+
+    value = _to_value(value)
+    match = _RANGE_PATTERN.match(value) if isinstance(value, str) else None
+    if match is None:
+        # values are passed as is, so that whitespaces and numeric taxon keys are preserved
+        return {"type": "equals", "key": gbif_key, "value": value}
+
+    lower, upper = match.groups()
+    bounds = []
+    if lower != "*":
+        bounds.append({"type": "greaterThanOrEquals", "key": gbif_key, "value": lower})
+    if upper != "*":
+        bounds.append({"type": "lessThanOrEquals", "key": gbif_key, "value": upper})
+    if not bounds:
+        raise ValueError("Range {} of {} has no bounds".format(value, key))
+    if len(bounds) == 1:
+        return bounds[0]
+    return {"type": "and", "predicates": bounds}
+
+
+def query_to_gbif_key(
+    queries: Dict,
+    mediatype: str = "StillImage",
+    user: Optional[str] = None,
+    pwd: Optional[str] = None,
+    email: Optional[str] = None,
+    poll_interval: int = 60,
+) -> str:
+    """Requests a GBIF download of a query and waits until its archive is ready
+
+    Large queries are much cheaper to retrieve as a single darwin core archive
+    than by paging through the search api. GBIF prepares downloads asynchronously,
+    this may take several minutes.
+
+    Args:
+        queries (Dict): dictionary of queries, as used by `gbif_dl.api.generate_urls`.
+            List values are combined with an `in` predicate, search api ranges
+            such as `year="2000,2010"` are converted into bounds.
+        mediatype (str, optional): Media type. Defaults to 'StillImage'.
+        user (str, optional): GBIF user name. Defaults to the `GBIF_USER` env variable.
+        pwd (str, optional): GBIF password. Defaults to the `GBIF_PWD` env variable.
+        email (str, optional): Notification email. Defaults to the `GBIF_EMAIL` env variable.
+        poll_interval (int, optional): Seconds between status requests. Defaults to 60.
+
+    Raises:
+        ValueError: If a query item cannot be expressed as a download predicate.
+        RuntimeError: If GBIF fails to prepare the download.
+
+    Returns:
+        str: gbif download key, to be passed to `generate_urls`
+    """
+    predicates = [_to_predicate(key, value) for key, value in queries.items()]
+    predicates.append(_to_predicate("mediatype", mediatype))
+    key, _ = pygbif.occurrences.download(
+        {"type": "and", "predicates": predicates},
+        format="DWCA",
+        user=user,
+        pwd=pwd,
+        email=email,
+    )
+
+    while True:
+        status = pygbif.occurrences.download_meta(key)["status"]
+        if status == "SUCCEEDED":
+            return key
+        if status in _FAILED_STATUSES:
+            raise RuntimeError("GBIF download {} ended with status {}".format(key, status))
+        time.sleep(poll_interval)
+
+
 def generate_urls(
     identifier: str,
     dwca_root_path=None,
@@ -161,7 +264,8 @@ def generate_urls(
     Returns:
         Iterable: item generator that yields files from generator
     """
-    if is_doi:
+    # only resolve actual DOIs, GBIF keys can be used without a datacite request
+    if is_doi(identifier):
         key = doi_to_gbif_key(identifier)
     else:
         key = identifier
@@ -4,10 +4,9 @@ Async based fast downloader.
 import asyncio
 import inspect
 from pathlib import Path
-from typing import AsyncGenerator, Callable, Generator, Union, Optional
+from typing import AsyncGenerator, Callable, Dict, Generator, Union, Optional, Set
 import sys
 import json
-import hashlib
 import random
 import logging
 from tqdm.contrib.logging import logging_redirect_tqdm
@@ -26,7 +25,7 @@ import aiohttp
 import aiostream
 from aiohttp_retry import RetryClient, ExponentialRetry
 from tqdm.asyncio import tqdm, tqdm_asyncio
-from .utils import run_async
+from .utils import run_async, hash_url
 
 
 class MediaData(TypedDict):
@@ -47,6 +46,7 @@ class DownloadParams(TypedDict):
     is_valid_file: Optional[Callable[[bytes], bool]]
     proxy: Optional[str]
     random_subsets: Optional[dict]
+    basenames: Dict[Path, Set[str]]
 
 
 async def download_single(
@@ -83,14 +83,19 @@ async def download_single(
         # append label path
         label_path /= Path(label)
 
-    label_path.mkdir(parents=True, exist_ok=True)
+    # labels repeat across many items, so each folder is only created and scanned once.
+    # Afterwards existing files are found with a set lookup instead of a glob per item
+    basenames = params["basenames"].get(label_path)
+    if basenames is None:
+        label_path.mkdir(parents=True, exist_ok=True)
+        basenames = {p.stem for p in label_path.iterdir()}
+        params["basenames"][label_path] = basenames
 
     if basename is None:
         # hash the url
-        basename = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        basename = hash_url(url)
 
-    check_files_with_same_basename = label_path.glob(basename + "*")
-    if list(check_files_with_same_basename) and not params["overwrite"]:
+    if basename in basenames and not params["overwrite"]:
         # do not overwrite, skips based on base path
         return False
 
@@ -118,6 +123,7 @@ async def download_single(
     file_path = file_base_path.with_suffix(suffix)
     async with aiofiles.open(file_path, "+wb") as f:
         await f.write(content)
+    basenames.add(basename)
 
     if isinstance(label, dict):
         json_path = (label_path / item["basename"]).with_suffix(".json")
@@ -325,6 +331,7 @@ def download(
         "is_valid_file": is_valid_file,
         "proxy": proxy,
         "random_subsets": random_subsets,
+        "basenames": {},
     }
 
     return run_async(
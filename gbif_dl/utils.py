@@ -3,11 +3,27 @@ Utility functions
 """
 import asyncio
 import functools
+import hashlib
 import threading
 from tqdm import tqdm
 from . import runners
 
 
+def hash_url(url: str) -> str:
+    """Hash a url into the basename of its media file
+
+    The SHA-1 digest is kept so that basenames stay stable across releases
+    and existing downloads are still detected when `overwrite` is disabled.
+
+    Args:
+        url (str): media url
+
+    Returns:
+        str: hex digest of the url
+    """
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
 def watchdog(afunc):
     """Stops all tasks if there is an error"""
 
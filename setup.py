@@ -21,7 +21,7 @@ setup(
         "aiohttp>=3.7.2",
         "aiohttp-retry>=2.3",
         "aiostream>=0.4.3",
-        "pygbif>=0.5.0",
+        "pygbif>=0.6.3",
         "requests-cache==0.7.4",
         "pescador>=2.1.0",
         "python-dwca-reader",
@@ -29,7 +29,7 @@ setup(
         "tqdm",
         "typing-extensions; python_version < '3.8'",
     ],
-    extras_require={"tests": ["pytest"], "docs": ["pdoc3"]},
+    extras_require={"tests": ["pytest"], "docs": ["pdoc3"], "speedups": ["orjson"]},
     # entry_points={"console_scripts": ["gbif_dl=gbif_dl.cli:download"]},
     packages=find_packages(),
     include_package_data=True,
@@ -48,3 +48,133 @@ def test_nb_samples_substreams(queries, key="speciesKey"):
 def test_gbif_query_count(queries):
     count = gbif_dl.api.gbif_count(**queries)
     assert count > 0
+
+
+def test_query_page_generator(queries):
+    page = next(gbif_dl.api.gbif_query_page_generator(page_limit=10, **queries))
+    assert 0 < len(page) <= 10
+    assert page[0]["url"]
+
+
+def test_last_page_is_yielded(monkeypatch):
+    """The final page has to be yielded without requesting another one"""
+    offsets = []
+
+    def search(offset=0, limit=300, **kwargs):
+        offsets.append(offset)
+        results = [
+            {"media": [{"type": "StillImage", "identifier": "https://example.org/%d" % i}]}
+            for i in range(offset, min(offset + limit, 5))
+        ]
+        return {"offset": offset, "endOfRecords": offset + limit >= 5, "results": results}
+
+    monkeypatch.setattr(gbif_dl.api, "_search", search)
+    items = list(gbif_dl.api.gbif_query_generator(page_limit=2))
+    assert len(items) == 5
+    assert offsets == [0, 2, 4]
+
+
+def test_search_arguments(monkeypatch):
+    """Positional and requests arguments are handled like pygbif"""
+    calls = []
+
+    class Response:
+        content = b'{"count": 3}'
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"count": 3}
+
+    def get(url, params=None, **kwargs):
+        calls.append((params, kwargs))
+        return Response()
+
+    monkeypatch.setattr(gbif_dl.api._SESSION, "get", get)
+    assert gbif_dl.api.gbif_count("StillImage", 12345, timeout=5, has_coordinate=True) == 3
+    params, kwargs = calls[0]
+    assert params["taxonKey"] == 12345
+    assert params["has.coordinate"] == "true"
+    assert "timeout" not in params
+    assert kwargs == {"timeout": 5}
+    assert "pygbif" in gbif_dl.api._SESSION.headers["User-Agent"]
+
+
+def test_session_is_kept(queries):
+    """Later calls must not replace the session of earlier generators unless the cache changes"""
+    gbif_dl.api.generate_urls(queries=queries)
+    session = gbif_dl.api._SESSION
+    gbif_dl.api.generate_urls(queries=queries)
+    assert gbif_dl.api._SESSION is session
+    gbif_dl.api.generate_urls(queries=queries, cache_requests=True)
+    assert gbif_dl.api._SESSION is not session
+    gbif_dl.api.generate_urls(queries=queries)
+    assert not isinstance(gbif_dl.api._SESSION, gbif_dl.api.requests_cache.CachedSession)
+
+
+def test_media_type_filter(monkeypatch):
+    """Only media of the queried types are yielded, media without type are kept"""
+    results = [
+        {
+            "media": [
+                {"type": "StillImage", "identifier": "https://example.org/a"},
+                {"type": "Sound", "identifier": "https://example.org/b"},
+                {"type": "StillImage", "identifier": "https://example.org/c"},
+            ]
+        },
+        {"media": [{"identifier": "https://example.org/d"}]},
+        {"media": [{"type": "Sound", "identifier": "https://example.org/e"}]},
+    ]
+
+    def search(offset=0, limit=300, **kwargs):
+        return {"offset": offset, "endOfRecords": True, "results": results}
+
+    monkeypatch.setattr(gbif_dl.api, "_search", search)
+
+    def urls(**kwargs):
+        return [
+            item["url"].rsplit("/", 1)[1] for item in gbif_dl.api.gbif_query_generator(**kwargs)
+        ]
+
+    assert urls(one_media_per_occurrence=False) == ["a", "c", "d"]
+    assert urls(one_media_per_occurrence=False, mediatype="stillimage") == ["a", "c", "d"]
+    assert urls(one_media_per_occurrence=False, mediatype=["StillImage", "Sound"]) == list("abcde")
+    for _ in range(10):
+        first, second = urls()
+        assert first in ("a", "c")
+        assert second == "d"
+
+
+def test_missing_label_is_skipped(monkeypatch):
+    """Occurrences without the label are skipped instead of labeled "None" """
+    results = [
+        {"speciesKey": 3189866, "media": [{"identifier": "https://example.org/a"}]},
+        {"media": [{"identifier": "https://example.org/b"}]},
+    ]
+
+    def search(offset=0, limit=300, **kwargs):
+        return {"offset": offset, "endOfRecords": True, "results": results}
+
+    monkeypatch.setattr(gbif_dl.api, "_search", search)
+    items = list(gbif_dl.api.gbif_query_generator(label="speciesKey"))
+    assert [item["label"] for item in items] == ["3189866"]
+
+
+def test_single_stream_nb_samples(monkeypatch, queries):
+    """Without split streams, -1 yields all samples and set limits are combined by their min"""
+
+    def search(offset=0, limit=300, **kwargs):
+        results = [{"media": [{"identifier": "https://example.org/%d" % i}]} for i in range(5)]
+        return {"offset": offset, "endOfRecords": True, "results": results}
+
+    monkeypatch.setattr(gbif_dl.api, "_search", search)
+
+    def nb_items(**kwargs):
+        return len(list(gbif_dl.api.generate_urls(queries=queries, **kwargs)))
+
+    assert nb_items(nb_samples=-1) == 5
+    assert nb_items(nb_samples=0) == 0
+    assert nb_items(nb_samples=4, nb_samples_per_stream=2) == 2
+    assert nb_items(nb_samples=2, nb_samples_per_stream=4) == 2
+    assert nb_items(nb_samples_per_stream=3) == 3
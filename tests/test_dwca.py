@@ -1,4 +1,5 @@
 import pytest
+from pathlib import Path
 import gbif_dl
 
 
@@ -28,3 +29,84 @@ def test_url_generator(doi):
     )
     item = next(data_generator)
     assert item["url"]
+
+
+def test_query_to_gbif_key(monkeypatch):
+    """Download requests are polled until the archive is ready"""
+    requested = []
+    status = iter(["PREPARING", "RUNNING", "SUCCEEDED"])
+
+    def download(queries, **kwargs):
+        requested.append(queries)
+        return "0000000-000000000000000", {}
+
+    monkeypatch.setattr(gbif_dl.dwca.pygbif.occurrences, "download", download)
+    monkeypatch.setattr(
+        gbif_dl.dwca.pygbif.occurrences, "download_meta", lambda key: {"status": next(status)}
+    )
+    queries = {
+        "speciesKey": [3189866, 3190653],
+        "scientificName": "Acer negundo L.",
+        "hasCoordinate": True,
+        "year": "2000,2010",
+    }
+    key = gbif_dl.dwca.query_to_gbif_key(queries, poll_interval=0)
+    assert key == "0000000-000000000000000"
+    assert requested == [
+        {
+            "type": "and",
+            "predicates": [
+                {"type": "in", "key": "SPECIES_KEY", "values": [3189866, 3190653]},
+                {"type": "equals", "key": "SCIENTIFIC_NAME", "value": "Acer negundo L."},
+                {"type": "equals", "key": "HAS_COORDINATE", "value": "true"},
+                {
+                    "type": "and",
+                    "predicates": [
+                        {"type": "greaterThanOrEquals", "key": "YEAR", "value": "2000"},
+                        {"type": "lessThanOrEquals", "key": "YEAR", "value": "2010"},
+                    ],
+                },
+                {"type": "equals", "key": "MEDIA_TYPE", "value": "StillImage"},
+            ],
+        }
+    ]
+
+
+def test_query_to_gbif_key_errors(monkeypatch):
+    monkeypatch.setattr(
+        gbif_dl.dwca.pygbif.occurrences, "download", lambda queries, **kwargs: ("0-0", {})
+    )
+    monkeypatch.setattr(
+        gbif_dl.dwca.pygbif.occurrences, "download_meta", lambda key: {"status": "FILE_ERASED"}
+    )
+    with pytest.raises(RuntimeError):
+        gbif_dl.dwca.query_to_gbif_key({"speciesKey": 3189866}, poll_interval=0)
+    with pytest.raises(ValueError):
+        gbif_dl.dwca.query_to_gbif_key({"notAGbifKey": 1}, poll_interval=0)
+    with pytest.raises(ValueError):
+        gbif_dl.dwca.query_to_gbif_key({"year": ["2000,2010"]}, poll_interval=0)
+
+
+def test_datacite_lookup_only_for_doi(monkeypatch, tmp_path, doi):
+    """GBIF download keys are used directly, only DOIs are resolved via datacite"""
+    lookups = []
+    downloads = []
+
+    def doi_to_gbif_key(identifier):
+        lookups.append(identifier)
+        return "0117522-200613084148143"
+
+    def download_get(key, path):
+        downloads.append(key)
+        return {"path": str(Path(path, key + ".zip"))}
+
+    monkeypatch.setattr(gbif_dl.dwca, "doi_to_gbif_key", doi_to_gbif_key)
+    monkeypatch.setattr(gbif_dl.dwca.pygbif.occurrences, "download_get", download_get)
+
+    gbif_dl.dwca.generate_urls("0000000-000000000000000", dwca_root_path=tmp_path)
+    assert lookups == []
+    assert downloads == ["0000000-000000000000000"]
+
+    gbif_dl.dwca.generate_urls(doi, dwca_root_path=tmp_path)
+    assert lookups == [doi]
+    assert downloads[-1] == "0117522-200613084148143"
@@ -53,3 +53,20 @@ def test_download_fromasybc(urls):
 def test_download_error(bad_urls):
     stats = gbif_dl.io.download(bad_urls)
     assert stats["failed"] == 1
+
+
+def test_existing_file_is_skipped(tmp_path):
+    """Existing files are found by their basename and not downloaded again"""
+    basename = "e75239cd029162c81f16a6d6afb1057d2437bcc8"
+    item = {"url": "https://example.org/image", "basename": basename, "label": "3189866"}
+    (tmp_path / "3189866").mkdir()
+    (tmp_path / "3189866" / (basename + ".jpg")).touch()
+    params = {
+        "root": str(tmp_path),
+        "overwrite": False,
+        "is_valid_file": None,
+        "proxy": None,
+        "random_subsets": None,
+        "basenames": {},
+    }
+    assert asyncio.run(gbif_dl.io.download_single(item, None, params)) is False